@@ -979,6 +979,14 @@ def convert_date_format(date_str):
         return date_str
 
 
+# Preguntas sugeridas del chat: (etiqueta del botón, key del widget, prompt enviado)
+_SUGGESTIONS = (
+    ("Muéstrame todos los campos", "btn_todos", "Muéstrame todos los campos detectados"),
+    ("Explícame los montos", "btn_montos", "Explícame los montos y la moneda"),
+    ("¿Cómo encontraste el CUIT?", "btn_cuit", "¿Cómo encontraste el CUIT?"),
+)
+
+
 def parse_amount(amount_str):
     """Parsea un monto desde string a float"""
     try:
@@ -1287,19 +1295,13 @@ with tab1:
         
         if user_input:
             # Agregar mensaje del usuario inmediatamente
+            # (el loop de historial de arriba lo renderiza en el próximo rerun,
+            # no hace falta pintarlo acá también)
             st.session_state.messages.append({
                 "role": "user",
                 "content": user_input
             })
-            
-            # Mostrar el mensaje del usuario en el chat
-            st.markdown(f"""
-            <div class="chat-message user-message">
-                <b>👤 Tú:</b><br>
-                {user_input}
-            </div>
-            """, unsafe_allow_html=True)
-            
+
             # Generar respuesta de CDP IA con streaming
             with st.chat_message("assistant"):
                 message_placeholder = st.empty()
@@ -1330,58 +1332,28 @@ with tab1:
         
         # Sugerencias de preguntas
         st.markdown("#### 💡 Preguntas sugeridas:")
-        col1, col2, col3 = st.columns(3)
-        
-        with col1:
-            if st.button("Muéstrame todos los campos", use_container_width=True, key="btn_todos"):
-                st.session_state.messages.append({
-                    "role": "user",
-                    "content": "Muéstrame todos los campos detectados"
-                })
-                response = generate_chat_response(
-                    "Muéstrame todos los campos detectados",
-                    st.session_state.extracted_data,
-                    st.session_state.pdf_text
-                )
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response
-                })
-                st.rerun()
-        
-        with col2:
-            if st.button("Explícame los montos", use_container_width=True, key="btn_montos"):
-                st.session_state.messages.append({
-                    "role": "user",
-                    "content": "Explícame los montos y la moneda"
-                })
-                response = generate_chat_response(
-                    "Explícame los montos y la moneda",
-                    st.session_state.extracted_data,
-                    st.session_state.pdf_text
-                )
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response
-                })
-                st.rerun()
-        
-        with col3:
-            if st.button("¿Cómo encontraste el CUIT?", use_container_width=True, key="btn_cuit"):
-                st.session_state.messages.append({
-                    "role": "user",
-                    "content": "¿Cómo encontraste el CUIT?"
-                })
-                response = generate_chat_response(
-                    "¿Cómo encontraste el CUIT?",
-                    st.session_state.extracted_data,
-                    st.session_state.pdf_text
-                )
-                st.session_state.messages.append({
-                    "role": "assistant",
-                    "content": response
-                })
-                st.rerun()
+        cols = st.columns(len(_SUGGESTIONS))
+
+        clicked_prompt = None
+        for col, (label, key, prompt) in zip(cols, _SUGGESTIONS):
+            if col.button(label, use_container_width=True, key=key):
+                clicked_prompt = prompt
+
+        if clicked_prompt:
+            st.session_state.messages.append({
+                "role": "user",
+                "content": clicked_prompt
+            })
+            response = generate_chat_response(
+                clicked_prompt,
+                st.session_state.extracted_data,
+                st.session_state.pdf_text
+            )
+            st.session_state.messages.append({
+                "role": "assistant",
+                "content": response
+            })
+            st.rerun()
 
 with tab2:
     st.markdown("### 📋 Datos Extraídos de la Factura")
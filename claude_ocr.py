@@ -5,171 +5,67 @@ Versión mejorada con soporte para OC, HES, HEM y desglose completo de IVAs
 """
 
 import anthropic
+import asyncio
+import functools
+import hashlib
 import os
 import json
+import logging
+import math
+import orjson
+import random
 import re
+import time
 
 
-def extract_invoice_with_claude(pdf_text, api_key=None):
-    """
-    Usa Claude API real para extraer datos de forma inteligente.
-    Claude analiza el texto completo y extrae campos automáticamente.
-    Detecta automáticamente la moneda (USD vs ARS) según el idioma y contexto.
-    Incluye nuevos campos: OC, HES, HEM y desglose completo de IVAs.
-    """
-    
-    if not api_key:
-        api_key = os.environ.get("ANTHROPIC_API_KEY")
-    
-    if not api_key:
-        raise ValueError("Se requiere ANTHROPIC_API_KEY en las variables de entorno")
-    
-    client = anthropic.Anthropic(api_key=api_key)
-    
-    prompt = f"""Eres un experto en análisis de facturas internacionales. Analiza el siguiente texto extraído de una factura y extrae TODA la información relevante.
-
-TEXTO DE LA FACTURA:
-{pdf_text}
-
-INSTRUCCIONES CRÍTICAS:
-1. Extrae TODOS los campos que encuentres
-2. NO inventes datos - solo extrae lo que realmente está en el texto
-3. Sé MUY PRECISO con números y fechas
-4. Para cada campo importante, indica tu nivel de confianza (0.0 a 1.0)
-5. Explica brevemente cómo encontraste cada campo importante
-
-**DETECCIÓN AUTOMÁTICA DE MONEDA (MUY IMPORTANTE):**
-Analiza el idioma y contexto del documento para determinar la moneda:
-
-REGLAS PARA USD (Dólares estadounidenses):
-- Documento EN INGLÉS (palabras: "invoice", "total", "amount", "tax")
-- Contiene explícitamente: "USD", "US$", "dollars", "US dollars"
-- Tiene Tax ID (en vez de CUIT) o EIN number
-- País: USA, United States, o sin país pero en inglés
-
-REGLAS PARA ARS (Pesos argentinos):
-- Documento EN ESPAÑOL (palabras: "factura", "total", "monto", "impuesto")
-- Contiene: "CUIT", "AFIP", "Argentina", "Ingresos Brutos"
-- Tiene CAE (Código de Autorización Electrónico)
-- Referencias geográficas argentinas (provincias, ciudades)
-
-REGLAS PARA OTRAS MONEDAS:
-- EUR: Europa, "€", "euros", idioma español/francés/alemán con referencias europeas
-- MXN: México, "MXN", "RFC" (en vez de CUIT)
-- CLP: Chile, "CLP", "RUT"
-- BRL: Brasil, "R$", "CNPJ"
-
-Si el símbolo "$" aparece sin aclaración explícita:
-- Documento en inglés → USD
-- Documento en español con CUIT/AFIP/Argentina → ARS
-- Documento en español sin referencias argentinas → revisar país
-
-IMPORTANTE: 
-- Incluye "currency" con el código ISO (USD, ARS, EUR, etc)
-- Incluye "currencySymbol" con el símbolo visual ($, US$, €, etc)
-- En "reasoning.currency" explica DETALLADAMENTE por qué elegiste esa moneda
-
-**IMPORTANTE - TIPO DE FACTURA ARGENTINA (CÓDIGOS AFIP):**
-En Argentina existen estos tipos de factura:
-- CÓDIGO AFIP 01 → Factura Tipo A (RI vende a RI)
-- CÓDIGO AFIP 06 → Factura Tipo B (RI vende a No RI / Consumidor)
-- CÓDIGO AFIP 11 → Factura Tipo C (Monotributista)
-
-Busca el "Código" con números de dos dígitos (01, 06, 11, etc) y traduce al tipo de letra correspondiente.
-Si ves "Factura A", "Factura B", "Factura C" directamente, usa ese valor.
-
-CAMPOS A BUSCAR (extrae todos los que encuentres):
-
-**PROVEEDOR (quien emite la factura):**
-- CUIT/Tax ID/RFC del proveedor
-- Razón social completa
-- Dirección
-- País
-
-**CLIENTE (a quien se le factura):**
-- Nombre/razón social del cliente
-- CUIT/Tax ID del cliente
-- Dirección del cliente
-- Código de cliente
-
-**FACTURA:**
-- Tipo (A, B, C, Invoice, etc)
-- Número completo
-- Punto de venta (si aplica)
-- CAE (si es factura argentina)
-- Fecha de emisión
-- Fecha de vencimiento
-- Período facturado (desde-hasta)
-
-**MONEDA Y MONTOS:**
-- Moneda detectada (USD, ARS, EUR, etc)
-- Símbolo usado ($, US$, €, etc)
-- Total a pagar (el monto final)
-- Subtotal / Importe Neto Gravado
-- Otros Tributos
-- IVA/Tax/Impuestos - CRÍTICO SOBRE DESGLOSE:
-  * SOLO incluye en ivaBreakdown las alícuotas que estén EXPLÍCITAMENTE mencionadas con formato:
-    - "IVA 0%: $X" o "IVA 0%: X"
-    - "IVA 2.5%: $X" o "IVA 2,5%: X"
-    - "IVA 5%: $X"
-    - "IVA 10.5%: $X" o "IVA 10,5%: X"
-    - "IVA 21%: $X"
-    - "IVA 27%: $X"
-  * Si el documento solo dice "I.V.A. INSC. %" o "IVA:" sin especificar alícuota → NO inventes el desglose
-  * Si el documento solo dice "IVA" con un monto total → pon ese monto en el campo "iva" pero deja ivaBreakdown en ceros
-  * NO ASUMAS que es IVA 21% si no está explícito
-  * Si no hay desglose explícito, todos los valores de ivaBreakdown deben ser 0.00
-- Monto gravado
-- Monto no gravado
-- Monto exento
-
-**DOCUMENTOS ASOCIADOS (MUY IMPORTANTE):**
-Busca cuidadosamente en el detalle de items y extrae si existen:
-- **OC** (Orden de Compra) - busca patrones como:
-  * "OC:" seguido de número (ej: OC: 4527976895)
-  * "Orden de Compra:" seguido de número
-  * "Purchase Order:" seguido de número
-  * Cualquier referencia a número de orden
-  
-- **HES** (Hoja de Entrada de Servicio) - busca patrones como:
-  * "HES:" seguido de número (ej: HES: 1024526137)
-  * "Hoja de Entrada de Servicio:" seguido de número
-  * "Service Entry Sheet:" seguido de número
-  
-- **HEM** (Hoja de Entrada de Materiales) - busca patrones como:
-  * "HEM:" seguido de número (ej: HEM: 1024526137)
-  * "Hoja de Entrada de Materiales:" seguido de número
-  * "Material Entry Sheet:" seguido de número
-  * "Goods Receipt:" seguido de número
-
-**ITEMS/LÍNEAS (si los hay):**
-Para cada item detecta:
-- Descripción de cada item
-- Cantidad
-- Precio unitario
-- Total por línea
-- Descuentos/bonificaciones
-- Alícuota de IVA aplicada
-- Si contiene "OC:" → extrae como "orden_compra"
-- Si contiene "HES:" → extrae como "hoja_entrada_servicio"
-- Si contiene "HEM:" → extrae como "hoja_entrada_materiales"
-
-FORMATO DE RESPUESTA:
-Responde ÚNICAMENTE con un JSON válido (sin ```json, sin markdown, sin explicaciones adicionales) con esta estructura EXACTA:
-
-{{
-  "supplier": {{
+# Instrucciones estáticas del prompt, separadas del texto variable de la factura.
+# Van como bloque `system` con cache_control ephemeral: Anthropic cachea este
+# prefijo entre llamadas y solo el texto de la factura se procesa/factura completo.
+# No modificar espacios/orden sin necesidad: cualquier cambio invalida la caché
+# (y hay que bumpear PROMPT_VERSION).
+_STATIC_INSTRUCTIONS = """<role>
+Eres un experto en análisis de facturas internacionales. El usuario te envía el texto extraído de una factura y devolvés TODOS los campos que encuentres. No inventes datos: extraé solo lo que está en el texto, con precisión en números y fechas. Para cada campo importante indicá tu confianza (0.0 a 1.0) y un razonamiento breve de cómo lo encontraste.
+</role>
+
+<currency_rules>
+Determiná la moneda por idioma y contexto del documento:
+- USD: documento en inglés ("invoice", "total", "tax"), o "USD"/"US$"/"dollars", o Tax ID/EIN en vez de CUIT, o país USA.
+- ARS: documento en español con CUIT/AFIP/CAE/"Ingresos Brutos" o referencias geográficas argentinas.
+- EUR: "€"/"euros", referencias europeas. MXN: "RFC". CLP: "RUT". BRL: "R$"/"CNPJ".
+- "$" sin aclaración: en inglés → USD; en español con CUIT/AFIP → ARS; si no, revisar el país.
+Incluí "currency" (código ISO) y "currencySymbol" (símbolo visual), y en reasoning.currency explicá por qué elegiste esa moneda.
+</currency_rules>
+
+<afip_codes>
+Tipo de factura argentina según código AFIP: 01 → A (RI vende a RI), 06 → B (RI vende a No RI/consumidor), 11 → C (monotributista). Buscá el "Código" de dos dígitos y traducilo a la letra; si aparece "Factura A/B/C" directamente, usá esa letra.
+</afip_codes>
+
+<fields>
+- Proveedor (emisor): CUIT/Tax ID/RFC, razón social completa, dirección, país.
+- Cliente (receptor): nombre, CUIT, dirección, código de cliente.
+- Factura: tipo, número completo, punto de venta, CAE, fecha de emisión, fecha de vencimiento, período facturado (desde-hasta).
+- Montos: total a pagar, neto gravado, no gravado, exento, otros tributos.
+- IVA: en ivaBreakdown cargá SOLO las alícuotas mencionadas explícitamente como "IVA X%: monto" (alícuotas posibles: 0, 2.5, 5, 10.5, 21, 27). Si el documento solo dice "IVA" o "I.V.A. INSC. %" con un monto total sin alícuota, ese monto va en "iva" y todo el desglose queda en 0.00. NO asumas 21% si no está explícito.
+- Documentos asociados, buscalos en el detalle de items: OC ("OC:", "Orden de Compra:", "Purchase Order:"), HES ("HES:", "Hoja de Entrada de Servicio:", "Service Entry Sheet:"), HEM ("HEM:", "Hoja de Entrada de Materiales:", "Goods Receipt:"). Cargá el número exacto como "orden_compra" / "hoja_entrada_servicio" / "hoja_entrada_materiales" en el item y explicá en reasoning dónde lo encontraste; si no están, usá null.
+- Items: descripción, cantidad, precio unitario, total por línea, descuentos/bonificaciones, alícuota de IVA aplicada.
+</fields>
+
+<schema>
+Respondé ÚNICAMENTE con un JSON válido (sin markdown ni explicaciones) con exactamente esta estructura:
+
+{
+  "supplier": {
     "cuit": "30-71017365-2 o Tax ID",
     "name": "Razón Social Exacta Como Aparece",
     "address": "Dirección completa o null",
     "country": "Argentina o null"
-  }},
-  "client": {{
+  },
+  "client": {
     "name": "Nombre exacto del cliente",
     "cuit": "30707542329 o null",
     "address": "Dirección o null",
     "code": "Código de cliente o null"
-  }},
+  },
   "currency": "ARS",
   "currencySymbol": "$",
   "invoiceType": "A",
@@ -178,25 +74,25 @@ Responde ÚNICAMENTE con un JSON válido (sin ```json, sin markdown, sin explica
   "cae": "74108913004192",
   "documentDate": "2024-03-08",
   "dueDate": "2024-03-18",
-  "billingPeriod": {{
+  "billingPeriod": {
     "from": "2024-03-01",
     "to": "2024-03-31"
-  }},
+  },
   "amount": 360564.27,
   "amountGrav": 297987.00,
   "amountNoGrav": 0,
   "amountExen": 0,
   "otherTaxes": 0.00,
-  "ivaBreakdown": {{
+  "ivaBreakdown": {
     "iva_0": 0.00,
     "iva_2_5": 0.00,
     "iva_5": 0.00,
     "iva_10_5": 0.00,
     "iva_21": 62577.27,
     "iva_27": 0.00
-  }},
+  },
   "items": [
-    {{
+    {
       "description": "Acceso Back Office Portal Proveedores",
       "quantity": 1,
       "unit_price": 297987.00,
@@ -206,110 +102,641 @@ Responde ÚNICAMENTE con un JSON válido (sin ```json, sin markdown, sin explica
       "orden_compra": "4527976895",
       "hoja_entrada_servicio": "1024526137",
       "hoja_entrada_materiales": null
-    }}
+    }
   ],
-  "confidence": {{
+  "confidence": {
     "supplier_cuit": 0.98,
-    "supplier_name": 0.95,
-    "client_name": 0.92,
     "invoice_number": 0.99,
-    "invoice_type": 0.95,
     "amount": 0.99,
-    "currency": 0.95,
-    "iva_breakdown": 0.98,
-    "orden_compra": 0.95,
-    "hoja_entrada_servicio": 0.95,
-    "hoja_entrada_materiales": 0.00
-  }},
-  "reasoning": {{
-    "supplier_name": "Encontré 'FRENCHELI GUSTAVO LEANDRO' como proveedor en el encabezado",
-    "invoice_type": "Encontré 'Código 01' que corresponde a Factura Tipo A según AFIP",
-    "amount": "Total de $360,564.27 claramente marcado como 'Importe Total'",
-    "currency": "Detecté ARS porque: (1) documento en español, (2) CUIT argentino 20232505088, (3) CAE 74108913004192 presente, (4) referencias a AFIP",
-    "iva_breakdown": "Desglosé los IVAs explícitos: IVA 21%: $62,577.27 sobre base de $297,987.00. Los demás están en 0 porque no aparecen en el documento.",
-    "orden_compra": "Encontré OC: 4527976895 en la columna de detalle del item",
-    "hoja_entrada_servicio": "Encontré HES: 1024526137 en la misma línea del item",
-    "hoja_entrada_materiales": "No encontré ninguna referencia a HEM en el documento"
-  }}
-}}
-
-REGLAS IMPORTANTES:
-- Fechas SIEMPRE en formato YYYY-MM-DD
-- Montos como números float (ej: 297987.00), NO strings
-- Si un campo no existe en el documento, usa null
-- NO inventes información que no esté en el texto
-- La confianza debe reflejar qué tan seguro estás (0.0 = nada seguro, 1.0 = completamente seguro)
-- En reasoning, explica BREVEMENTE cómo encontraste los campos más importantes
-- **CRÍTICO - DESGLOSE DE IVA:**
-  * Solo incluye valores en ivaBreakdown si el documento dice EXPLÍCITAMENTE "IVA X%: $monto"
-  * Si solo dice "I.V.A. INSC. %" o "IVA: $monto" sin alícuota → todos los ivaBreakdown en 0.00
-  * Ejemplo 1: Documento dice "IVA 21%: $62,577.27" → iva_21: 62577.27
-  * Ejemplo 2: Documento dice "I.V.A. INSC. %: 6546.96" → TODOS los ivaBreakdown en 0.00, iva: 6546.96
-  * Ejemplo 3: No menciona IVA → iva: 0.00 y todos los ivaBreakdown en 0.00
-  * NO asumas la alícuota basándote en el país o tipo de factura
-- Para OC, HES, HEM: incluye el número exacto si está presente, sino usa null
-- Si encuentras OC/HES/HEM, también inclúyelos en el reasoning explicando dónde los encontraste
+    "currency": 0.95
+  },
+  "reasoning": {
+    "amount": "Total de $360,564.27 claramente marcado como \'Importe Total\'",
+    "currency": "Detecté ARS por documento en español, CUIT argentino y CAE presente"
+  }
+}
+</schema>
+
+<rules>
+- Fechas SIEMPRE en formato YYYY-MM-DD; montos como números float, NO strings; null para campos ausentes.
+- La confianza debe reflejar qué tan seguro estás (0.0 = nada seguro, 1.0 = completamente seguro).
+</rules>
 """
 
+
+# Versión del prompt: bumpear cuando cambie _STATIC_INSTRUCTIONS para que
+# las entradas viejas de la caché dejen de matchear.
+PROMPT_VERSION = "v2"
+
+# Caché en disco de resultados ya parseados, clave = sha256(versión + texto).
+# Evita pagar la llamada completa a Claude cuando se reprocesa la misma factura
+# (re-uploads, reintentos, corridas de prueba).
+_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".claude_cache")
+_CACHE_TTL = 7 * 86400  # 7 días, en segundos
+
+
+@functools.lru_cache(maxsize=4)
+def _get_client(api_key):
+    """Un solo anthropic.Anthropic por api_key: el httpx.Client interno
+    mantiene viva la conexión TLS, así no se paga el handshake en cada llamada.
+    max_retries=0 porque los reintentos los maneja nuestro loop de backoff;
+    con el default del SDK (2) se apilarían los dos niveles de reintento"""
+    return anthropic.Anthropic(api_key=api_key, max_retries=0)
+
+
+# Límites de sanidad sobre el texto OCR antes de pagar una llamada a la API
+_MIN_TEXT_LEN = 20
+_MAX_TEXT_LEN = 50_000
+_TAIL_TEXT_LEN = 10_000
+
+# El OCR mete espacios repetidos, form feeds y corridas de líneas en blanco:
+# inflan tokens y hacen que facturas idénticas no peguen en la caché.
+# Se colapsan runs horizontales pero se preservan los saltos de línea,
+# que codifican la estructura de la factura. Los \r se eliminan (CRLF → \n)
+# antes que nada: colapsarlos a espacio dejaba un espacio colgando al final
+# de cada línea de un PDF con finales de línea Windows.
+_CR_RE = re.compile(r'\r\n?')
+_WS_RE = re.compile(r'[ \t\f]+')
+_NL_RE = re.compile(r'\n{3,}')
+# Líneas separadoras de puro ---- / ____ / ====: decorativas, afuera
+# (tolerando la indentación que el OCR suele dejar alrededor)
+_SEP_RE = re.compile(r'^[ \t]*[-_=*]{4,}[ \t]*$', re.MULTILINE)
+
+logger = logging.getLogger(__name__)
+
+# Resueltos una sola vez al importar: saca el lookup de os.environ del hot path.
+# El parámetro api_key de las funciones sigue permitiendo override (tests).
+_API_KEY = os.environ.get("ANTHROPIC_API_KEY")
+_MODEL = os.environ.get("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+_MODEL_FAST = os.environ.get("CLAUDE_MODEL_FAST", "claude-haiku-4-5")
+
+# Ruteo por complejidad: debajo de este largo de texto la factura va a Haiku;
+# si la confianza de algún campo queda bajo el piso, se reintenta con Sonnet
+_FAST_TEXT_LIMIT = 3000
+_CONFIDENCE_FLOOR = 0.7
+
+# Reintentos ante errores transitorios (429/5xx/conexión): backoff exponencial
+# arrancando corto (0.5s) con jitter. Los 4xx terminales no se reintentan.
+_MAX_RETRIES = 5
+_NO_RETRY_STATUS = (400, 401, 403, 404, 422)
+
+# Techo duro de salida (el presupuesto original del repo): si el presupuesto
+# dinámico quedó corto y la respuesta se truncó, se reintenta una vez con esto
+_MAX_OUTPUT_TOKENS = 4000
+
+# Bloque system compartido (el prefijo cacheado) y el agregado opcional para
+# suprimir el objeto "reasoning". El agregado va DESPUÉS del breakpoint de
+# cache_control, así ambas variantes comparten el mismo prefijo cacheado.
+_SYSTEM_CACHED = [{
+    "type": "text",
+    "text": _STATIC_INSTRUCTIONS,
+    "cache_control": {"type": "ephemeral"},
+}]
+# Variante para batches: TTL de 1 hora, porque un batch grande tarda más que
+# la ventana default de 5 minutos y conviene que todos los requests peguen
+# en el mismo prefijo cacheado
+_SYSTEM_CACHED_1H = [{
+    "type": "text",
+    "text": _STATIC_INSTRUCTIONS,
+    "cache_control": {"type": "ephemeral", "ttl": "1h"},
+}]
+# El TTL extendido de 1h sigue detrás de un header beta: sin mandarlo, todo
+# request que use _SYSTEM_CACHED_1H rebota con 400
+_EXTENDED_TTL_BETA = {"anthropic-beta": "extended-cache-ttl-2025-04-11"}
+_NO_REASONING_NOTE = {
+    "type": "text",
+    "text": '<output_opts>\nOmití por completo el objeto "reasoning" de la respuesta.\n</output_opts>',
+}
+
+
+def _system_blocks(include_reasoning, long_ttl=False):
+    base = _SYSTEM_CACHED_1H if long_ttl else _SYSTEM_CACHED
+    if include_reasoning:
+        return base
+    return base + [_NO_REASONING_NOTE]
+
+
+# Pre-extracción determinística: lo que un regex encuentra con certeza no hace
+# falta que el modelo lo salga a cazar; se le pasa como pista a verificar, lo
+# que baja tokens de salida y la tasa de error en estos campos numéricos.
+_PREEXTRACT_PATTERNS = {
+    "cae": re.compile(r"CAE[:\s]+(\d{14})", re.IGNORECASE),
+    "cuit": re.compile(r"\b(\d{2}-?\d{8}-?\d)\b"),
+    "oc": re.compile(r"\bOC[:\s]+(\d+)"),
+    "hes": re.compile(r"\bHES[:\s]+(\d+)"),
+    "hem": re.compile(r"\bHEM[:\s]+(\d+)"),
+}
+
+
+def _preextract(pdf_text):
+    """Matchea localmente CAE/CUIT/OC/HES/HEM y devuelve {campo: [valores]}"""
+    hints = {}
+    for field, pattern in _PREEXTRACT_PATTERNS.items():
+        found = pattern.findall(pdf_text)
+        if found:
+            hints[field] = sorted(set(found))
+    return hints
+
+
+def _user_content(pdf_text):
+    """Arma el mensaje de usuario: pistas pre-extraídas + texto de la factura"""
+    hints = _preextract(pdf_text)
+    parts = []
+    if hints:
+        rendered = "; ".join(f"{k.upper()}={', '.join(v)}" for k, v in hints.items())
+        parts.append("PISTAS PRE-EXTRAÍDAS POR REGEX (verificar contra el texto): " + rendered)
+    parts.append("TEXTO DE LA FACTURA:\n" + pdf_text)
+    return "\n\n".join(parts)
+
+
+def _validate_text(pdf_text):
+    """Corta temprano los inputs patológicos: un texto vacío no tiene nada que
+    extraer, y un OCR gigante se trunca a un presupuesto que alcanza para
+    prácticamente cualquier factura"""
+    text = _CR_RE.sub('\n', pdf_text)
+    text = _SEP_RE.sub('', text)
+    text = _WS_RE.sub(' ', text)
+    text = _NL_RE.sub('\n\n', text)
+    text = text.strip()
+    if len(text) < _MIN_TEXT_LEN:
+        raise ValueError(
+            f"pdf_text demasiado corto ({len(text)} caracteres) para ser una factura")
+    if len(text) > _MAX_TEXT_LEN:
+        logger.warning("pdf_text de %d caracteres, truncando a %d", len(text), _MAX_TEXT_LEN)
+        # Se conserva cabecera y cola: los datos del emisor van arriba y los
+        # totales/CAE abajo, el medio suele ser detalle de ítems repetitivo
+        head = _MAX_TEXT_LEN - _TAIL_TEXT_LEN
+        text = text[:head] + "\n[... texto intermedio omitido ...]\n" + text[-_TAIL_TEXT_LEN:]
+    return text
+
+
+def _cache_key(pdf_text, model=None, include_reasoning=True):
+    """Clave de caché: hash del texto normalizado (espacios colapsados) + versión
+    del prompt + modelo + variante de salida, así un resultado de Haiku no pisa
+    uno de Sonnet ni uno sin reasoning a uno completo"""
+    normalized = ' '.join(pdf_text.split())
+    variant = "" if include_reasoning else "+nr"
+    return hashlib.sha256(
+        (PROMPT_VERSION + (model or _MODEL) + variant + normalized).encode()).hexdigest()
+
+
+def _cache_get(key):
+    """Devuelve el resultado cacheado o None si no existe / expiró / está corrupto"""
+    path = os.path.join(_CACHE_DIR, key + ".json")
+    try:
+        if time.time() - os.path.getmtime(path) > _CACHE_TTL:
+            return None
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _cache_set(key, result):
+    """Guarda el resultado en la caché (best-effort, nunca rompe la extracción)"""
+    try:
+        os.makedirs(_CACHE_DIR, exist_ok=True)
+        with open(os.path.join(_CACHE_DIR, key + ".json"), "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+    except OSError:
+        pass
+
+
+def _json_from_stream(text_stream):
+    """Acumula el texto streameado y corta apenas se cierra el objeto JSON
+    de nivel superior (el prefill ya abrió el '{' inicial). Así no se espera
+    por tokens de cola que el modelo pudiera emitir después del JSON.
+    Devuelve (texto, cerrado): cerrado=False significa que el stream se agotó
+    sin cerrar el objeto (típicamente un corte por max_tokens)."""
+    parts = []
+    depth = 1
+    in_string = False
+    escaped = False
+
+    for chunk in text_stream:
+        for i, ch in enumerate(chunk):
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == '\\':
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == '{':
+                depth += 1
+            elif ch == '}':
+                depth -= 1
+                if depth == 0:
+                    # Cortar acá: lo que venga después del cierre no es JSON
+                    parts.append(chunk[:i + 1])
+                    return ''.join(parts), True
+        parts.append(chunk)
+
+    return ''.join(parts), False
+
+
+def _repair_truncated_json(response_text):
+    """Intenta reparar un JSON cortado por max_tokens cerrando el string y las
+    llaves/corchetes pendientes. Devuelve el dict parseado o None si ni así
+    parsea; los errores estructurales de verdad siguen fallando"""
+    depth_stack = []
+    in_string = False
+    escaped = False
+    for ch in response_text:
+        if escaped:
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '"':
+            in_string = not in_string
+        elif not in_string:
+            if ch in '{[':
+                depth_stack.append('}' if ch == '{' else ']')
+            elif ch in '}]' and depth_stack:
+                depth_stack.pop()
+    candidate = response_text.rstrip()
+    if escaped:
+        candidate += '\\'
+    if in_string:
+        candidate += '"'
+    # Una coma o dos puntos colgando invalidan el cierre directo
+    candidate = candidate.rstrip().rstrip(',')
+    if candidate.endswith(':'):
+        candidate += ' null'
+    candidate += ''.join(reversed(depth_stack))
     try:
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=4000,
-            temperature=0,  # Determinístico para extracción de datos
-            messages=[{
-                "role": "user",
-                "content": prompt
-            }]
+        result = orjson.loads(candidate)
+    except orjson.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+# Claves que el resto del pipeline asume presentes; las factories evitan
+# compartir el mismo dict/list mutable entre resultados
+_RESULT_DEFAULTS = (
+    ('supplier', dict),
+    ('client', dict),
+    ('confidence', dict),
+    ('reasoning', dict),
+    ('ivaBreakdown', dict),
+    ('items', list),
+)
+
+
+def _parse_result(response_text):
+    """Parsea el JSON de la respuesta de Claude y asegura las claves mínimas.
+    Con el prefill del turno assistant en '{' la respuesta ya viene como JSON
+    crudo, sin fences de markdown que haya que limpiar."""
+
+    # Parsear JSON (orjson es ~2-5x más rápido que el json de la stdlib)
+    try:
+        result = orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
+        # Intento de rescate local antes de descartar (y re-facturar) la
+        # llamada completa: el modo de falla típico es un corte por
+        # max_tokens, que deja strings y llaves sin cerrar
+        repaired = _repair_truncated_json(response_text)
+        if repaired is not None:
+            logger.warning("Respuesta truncada reparada localmente (%d chars)",
+                           len(response_text))
+            result = repaired
+        else:
+            logger.exception("Respuesta de Claude no parseable (primeros 500 chars): %s",
+                             response_text[:500])
+            raise Exception(f"Claude no retornó JSON válido: {str(e)}")
+
+    # Validar estructura básica
+    if not isinstance(result, dict):
+        raise ValueError("La respuesta no es un diccionario válido")
+
+    # Asegurar que tenga las claves mínimas
+    for key, default in _RESULT_DEFAULTS:
+        result.setdefault(key, default())
+
+    # Derivar el IVA total del desglose si el modelo lo omitió. fsum suma con
+    # redondeo correcto (es dinero); se filtran valores no numéricos por si el
+    # modelo devuelve algún string en el desglose
+    if not result.get('iva'):
+        total_iva = math.fsum(
+            v for v in result['ivaBreakdown'].values()
+            if isinstance(v, (int, float))
         )
-        
-        response_text = message.content[0].text
-        
-        # Limpiar respuesta (quitar markdown si Claude lo agregó)
-        response_text = re.sub(r'```json\s*', '', response_text)
-        response_text = re.sub(r'```\s*', '', response_text)
-        response_text = response_text.strip()
-        
-        # Parsear JSON
-        result = json.loads(response_text)
-        
-        # Validar estructura básica
-        if not isinstance(result, dict):
-            raise ValueError("La respuesta no es un diccionario válido")
-        
-        # Asegurar que tenga las claves mínimas
-        if 'supplier' not in result:
-            result['supplier'] = {}
-        if 'client' not in result:
-            result['client'] = {}
-        if 'confidence' not in result:
-            result['confidence'] = {}
-        if 'reasoning' not in result:
-            result['reasoning'] = {}
-        if 'ivaBreakdown' not in result:
-            result['ivaBreakdown'] = {}
-        if 'items' not in result:
-            result['items'] = []
-        
-        # Asegurar que tenga moneda (default ARS si no detecta)
-        if 'currency' not in result:
-            result['currency'] = 'ARS'
-            result['currencySymbol'] = '$'
-            result['reasoning']['currency'] = 'No se pudo determinar con certeza, asumiendo ARS por defecto'
-        
+        if total_iva > 0:
+            result['iva'] = total_iva
+
+    # Asegurar que tenga moneda (default ARS si no detecta)
+    if 'currency' not in result:
+        result['currency'] = 'ARS'
+        result['currencySymbol'] = '$'
+        result['reasoning']['currency'] = 'No se pudo determinar con certeza, asumiendo ARS por defecto'
+
+    return result
+
+
+def _dynamic_max_tokens(pdf_text):
+    """Presupuesto de salida proporcional al documento: ~400 tokens cubren los
+    campos fijos y se agrega margen por línea de detalle, con techo en 1500"""
+    return min(1500, 400 + 40 * pdf_text.count('\n'))
+
+
+def _choose_model(pdf_text):
+    """Ruteo por complejidad: una factura corta no necesita Sonnet.
+    Haiku es varias veces más rápido y barato; si duda, se escala (ver
+    _low_confidence en el caller)."""
+    if len(pdf_text) < _FAST_TEXT_LIMIT:
+        return _MODEL_FAST
+    return _MODEL
+
+
+def _low_confidence(result):
+    """True si algún campo vino con confianza por debajo del piso"""
+    for conf in result.get('confidence', {}).values():
+        if not isinstance(conf, (int, float)):
+            continue
+        if (conf if conf <= 1 else conf / 100) < _CONFIDENCE_FLOOR:
+            return True
+    return False
+
+
+def _stream_once(client, pdf_text, model, max_tokens, include_reasoning):
+    """Una llamada streameada contra `model`, con reintentos ante errores
+    transitorios (backoff + jitter). Devuelve (texto, truncado): truncado=True
+    si el modelo cortó por max_tokens antes de cerrar el JSON."""
+    for attempt in range(_MAX_RETRIES + 1):
+        try:
+            with client.messages.stream(
+                model=model,
+                max_tokens=max_tokens,
+                temperature=0,  # Determinístico para extracción de datos
+                system=_system_blocks(include_reasoning),
+                messages=[{
+                    "role": "user",
+                    "content": _user_content(pdf_text)
+                }, {
+                    # Prefill: forzamos que la respuesta arranque como JSON crudo,
+                    # sin fences de markdown
+                    "role": "assistant",
+                    "content": "{"
+                }]
+            ) as stream:
+                response_text, closed = _json_from_stream(stream.text_stream)
+                truncated = False
+                if not closed:
+                    # El stream se agotó sin cerrar el JSON: distinguir un corte
+                    # por presupuesto (recuperable subiendo max_tokens) de una
+                    # respuesta genuinamente malformada
+                    truncated = stream.get_final_message().stop_reason == "max_tokens"
+
+            return response_text, truncated
+
+        except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+            status = getattr(e, "status_code", None)
+            if attempt == _MAX_RETRIES or status in _NO_RETRY_STATUS:
+                raise
+            delay = 0.5 * (2 ** attempt) + random.uniform(0, 0.25)
+            logger.warning("Error transitorio de API (%s), reintento %d en %.2fs",
+                           status or type(e).__name__, attempt + 1, delay)
+            time.sleep(delay)
+
+
+def _stream_extract(client, pdf_text, model, max_tokens, include_reasoning=True):
+    """Una llamada de extracción streameada contra `model`, ya parseada.
+    Streaming: empezamos a acumular apenas llega el primer token y cortamos
+    cuando el JSON de nivel superior se cierra, sin esperar la completion entera.
+    Si la respuesta quedó cortada por max_tokens se reintenta una vez con el
+    techo duro; devuelve (resultado, truncado) para que el caller no cachee
+    un resultado reparado a medias."""
+    response_text, truncated = _stream_once(
+        client, pdf_text, model, max_tokens, include_reasoning)
+
+    if truncated and max_tokens < _MAX_OUTPUT_TOKENS:
+        logger.warning("Respuesta cortada con max_tokens=%d, reintentando con %d",
+                       max_tokens, _MAX_OUTPUT_TOKENS)
+        response_text, truncated = _stream_once(
+            client, pdf_text, model, _MAX_OUTPUT_TOKENS, include_reasoning)
+
+    return _parse_result("{" + response_text), truncated
+
+
+def extract_invoice_with_claude(pdf_text, api_key=None, max_tokens=None,
+                                include_reasoning=True):
+    """
+    Usa Claude API real para extraer datos de forma inteligente.
+    Claude analiza el texto completo y extrae campos automáticamente.
+    Detecta automáticamente la moneda (USD vs ARS) según el idioma y contexto.
+    Incluye nuevos campos: OC, HES, HEM y desglose completo de IVAs.
+    Las instrucciones estáticas van como system block cacheado (prompt caching),
+    así cada llamada solo paga los tokens del texto de la factura.
+    Los documentos cortos se rutean a Haiku y se escalan a Sonnet solo si
+    la extracción vuelve con confianza baja.
+    Con include_reasoning=False se le pide al modelo omitir el objeto
+    "reasoning" (menos tokens de salida); la UI de chat lo consume, así que
+    el default queda en True.
+    """
+
+    if not api_key:
+        api_key = _API_KEY
+
+    if not api_key:
+        raise ValueError("Se requiere ANTHROPIC_API_KEY en las variables de entorno")
+
+    pdf_text = _validate_text(pdf_text)
+    model = _choose_model(pdf_text)
+    if max_tokens is None:
+        max_tokens = _dynamic_max_tokens(pdf_text)
+
+    # Mismo texto ya procesado → devolver el resultado cacheado sin llamar a la API
+    cache_key = _cache_key(pdf_text, model, include_reasoning)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    client = _get_client(api_key)
+
+    try:
+        result, truncated = _stream_extract(client, pdf_text, model, max_tokens,
+                                            include_reasoning)
+
+        # Si el modelo chico dudó, un reintento con el grande sigue siendo
+        # más barato que mandar todo a Sonnet siempre
+        if model != _MODEL and _low_confidence(result):
+            logger.info("Confianza baja con %s, reintentando con %s", model, _MODEL)
+            result, truncated = _stream_extract(client, pdf_text, _MODEL, max_tokens,
+                                                include_reasoning)
+
+        # Un resultado reparado tras un corte por max_tokens puede venir con la
+        # cola de items/confidence faltante: se devuelve pero nunca se cachea
+        if not truncated:
+            _cache_set(cache_key, result)
+
         return result
-        
-    except json.JSONDecodeError as e:
-        print(f"❌ Error parseando JSON de Claude: {e}")
-        print(f"📄 Respuesta recibida (primeros 500 chars): {response_text[:500]}")
-        raise Exception(f"Claude no retornó JSON válido: {str(e)}")
-        
+
     except anthropic.APIError as e:
-        print(f"❌ Error en API de Anthropic: {e}")
+        logger.exception("Error en API de Anthropic")
         raise Exception(f"Error de API: {str(e)}")
-        
-    except Exception as e:
-        print(f"❌ Error inesperado: {e}")
-        raise
+
+
+async def _extract_one(client, pdf_text, sem, include_reasoning=True):
+    """Extrae una factura contra un cliente async, respetando el semáforo de
+    concurrencia. Mismo backoff que el path sync; el sleep se hace con el
+    semáforo tomado para bajar la presión mientras la API devuelve 429."""
+    pdf_text = _validate_text(pdf_text)
+    cache_key = _cache_key(pdf_text, include_reasoning=include_reasoning)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    async with sem:
+        for attempt in range(_MAX_RETRIES + 1):
+            try:
+                message = await client.messages.create(
+                    model=_MODEL,
+                    max_tokens=_dynamic_max_tokens(pdf_text),
+                    temperature=0,
+                    system=_system_blocks(include_reasoning),
+                    messages=[{
+                        "role": "user",
+                        "content": _user_content(pdf_text)
+                    }, {
+                        "role": "assistant",
+                        "content": "{"
+                    }]
+                )
+                break
+            except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+                status = getattr(e, "status_code", None)
+                if attempt == _MAX_RETRIES or status in _NO_RETRY_STATUS:
+                    raise
+                delay = 0.5 * (2 ** attempt) + random.uniform(0, 0.25)
+                logger.warning("Error transitorio de API (%s), reintento %d en %.2fs",
+                               status or type(e).__name__, attempt + 1, delay)
+                await asyncio.sleep(delay)
+
+    result = _parse_result("{" + message.content[0].text)
+    # Mismo criterio que el path sync: un resultado cortado por max_tokens
+    # (y reparado a medias) no se cachea
+    if message.stop_reason != "max_tokens":
+        _cache_set(cache_key, result)
+    return result
+
+
+async def extract_invoices_batch(pdf_texts, concurrency=8, api_key=None,
+                                 include_reasoning=True):
+    """
+    Extrae varias facturas en paralelo con AsyncAnthropic.
+    Comparte un solo cliente HTTP y limita las llamadas en vuelo con un
+    semáforo para no pasarse de los rate limits de Anthropic.
+    Devuelve los resultados en el mismo orden que pdf_texts; si una factura
+    falla, su posición contiene la excepción en lugar del dict.
+    """
+
+    if not api_key:
+        api_key = _API_KEY
+
+    if not api_key:
+        raise ValueError("Se requiere ANTHROPIC_API_KEY en las variables de entorno")
+
+    # Cliente por corrida, no cacheado: un AsyncAnthropic reutilizado entre
+    # event loops queda con el pool de httpx atado a un loop ya cerrado y el
+    # segundo asyncio.run() del proceso falla. max_retries=0 porque el backoff
+    # lo maneja _extract_one.
+    async with anthropic.AsyncAnthropic(api_key=api_key, max_retries=0) as client:
+        sem = asyncio.Semaphore(concurrency)
+
+        return await asyncio.gather(
+            *(_extract_one(client, text, sem, include_reasoning) for text in pdf_texts),
+            return_exceptions=True
+        )
+
+
+def extract_invoices_bulk(pdf_texts, api_key=None, poll_interval=30,
+                          timeout=24 * 3600, include_reasoning=True):
+    """
+    Procesamiento masivo/offline vía la Message Batches API de Anthropic.
+    Cuesta 50% menos que las llamadas en vivo y tolera mucho más throughput,
+    ideal para backfills o re-extracciones nocturnas. Bloquea hasta que el
+    batch termina (o hasta `timeout` segundos) y devuelve los resultados en
+    el mismo orden que pdf_texts; las facturas que fallan la validación o el
+    batch quedan como excepción en su posición. Comparte la caché en disco
+    con los otros paths: los hits no se mandan al batch.
+    """
+
+    if not api_key:
+        api_key = _API_KEY
+
+    if not api_key:
+        raise ValueError("Se requiere ANTHROPIC_API_KEY en las variables de entorno")
+
+    # Mismo pipeline de entrada que los paths sync/async: normalizar, cortar
+    # temprano los textos inválidos y resolver por caché lo ya procesado
+    results = [None] * len(pdf_texts)
+    pending = []  # (índice, texto validado, clave de caché)
+    for i, text in enumerate(pdf_texts):
+        try:
+            text = _validate_text(text)
+        except ValueError as e:
+            results[i] = e
+            continue
+        cache_key = _cache_key(text, include_reasoning=include_reasoning)
+        cached = _cache_get(cache_key)
+        if cached is not None:
+            results[i] = cached
+            continue
+        pending.append((i, text, cache_key))
+
+    if not pending:
+        return results
+
+    client = _get_client(api_key)
+
+    batch = client.messages.batches.create(
+        requests=[{
+            "custom_id": f"inv-{i}",
+            "params": {
+                "model": _MODEL,
+                "max_tokens": _dynamic_max_tokens(text),
+                "temperature": 0,
+                "system": _system_blocks(include_reasoning, long_ttl=True),
+                "messages": [{
+                    "role": "user",
+                    "content": _user_content(text)
+                }, {
+                    "role": "assistant",
+                    "content": "{"
+                }],
+            },
+        } for i, text, _ in pending],
+        extra_headers=_EXTENDED_TTL_BETA,
+    )
+
+    # Esperar a que el batch termine de procesarse, con tope: la API garantiza
+    # resolución en 24h, si seguimos esperando después de eso algo está mal
+    deadline = time.monotonic() + timeout
+    while batch.processing_status != "ended":
+        if time.monotonic() >= deadline:
+            raise TimeoutError(
+                f"Batch {batch.id} no terminó después de {timeout}s "
+                f"(estado: {batch.processing_status})")
+        time.sleep(poll_interval)
+        batch = client.messages.batches.retrieve(batch.id)
+
+    # Reordenar por custom_id: los resultados del batch no vienen en orden
+    cache_keys = {i: key for i, _, key in pending}
+    for entry in client.messages.batches.results(batch.id):
+        idx = int(entry.custom_id.split("-", 1)[1])
+        if entry.result.type == "succeeded":
+            message = entry.result.message
+            result = _parse_result("{" + message.content[0].text)
+            # Igual que los otros paths: lo truncado/reparado no se cachea
+            if message.stop_reason != "max_tokens":
+                _cache_set(cache_keys[idx], result)
+            results[idx] = result
+        else:
+            results[idx] = Exception(f"Factura {entry.custom_id}: batch terminó en '{entry.result.type}'")
+
+    return results
 
 
 def test_extraction():
@@ -320,31 +747,31 @@ def test_extraction():
     Factura A Nº 00005-00000121
     Código 01
     Fecha: 08/03/2024
-    
+
     Cliente: LAN ARGENTINA SOCIEDAD ANONIMA
     CUIT: 30707542329
-    
+
     Detalle:
     Acceso Back Office Portal Proveedores
     OC: 4527976895
     HES: 1024526137
     Cantidad: 1
     Precio Unit.: $ 297987,00
-    
+
     Importe Neto Gravado: $ 297987,00
     IVA 21%: $ 62577,27
     Importe Total: $ 360564,27
-    
+
     CAE: 74108913004192
     """
-    
+
     try:
         result = extract_invoice_with_claude(sample_text)
         print("✅ Extracción exitosa:")
-        print(json.dumps(result, indent=2, ensure_ascii=False))
+        print(orjson.dumps(result, option=orjson.OPT_INDENT_2).decode())
     except Exception as e:
         print(f"❌ Error: {e}")
 
 
 if __name__ == "__main__":
-    test_extraction()
\ No newline at end of file
+    test_extraction()